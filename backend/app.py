@@ -5,63 +5,196 @@ import hmac
 import json
 import time
 import logging
+import math
 import threading
+from collections import deque
 from datetime import datetime, timedelta, date
 from functools import wraps
+from typing import Optional
 import secrets
 import re
 
-from flask import Flask, request, jsonify, g, make_response
+from flask import Flask, request, g, make_response
 from werkzeug.middleware.proxy_fix import ProxyFix
 import jwt  # PyJWT
 
-# ==== Logging (DEBUG) ====
-logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(levelname)s %(message)s')
-logging.debug("Starting app module import")
+try:
+    import orjson
+except ImportError:  # pragma: no cover - stdlib fallback
+    orjson = None
+
+try:
+    # Precomputes the HMAC ipad/opad states once per call; output matches hashlib
+    from fastpbkdf2 import pbkdf2_hmac as _pbkdf2_hmac
+except ImportError:  # pragma: no cover - stdlib fallback
+    _pbkdf2_hmac = hashlib.pbkdf2_hmac
+
+# ==== Logging ====
+logging.basicConfig(level=os.environ.get("APP_LOG_LEVEL", "INFO").upper(), format='[%(asctime)s] %(levelname)s %(message)s')
+log = logging.getLogger(__name__)
+log.debug("Starting app module import")
 
 # ==== Configuration ====
 SECRET_KEY = os.environ.get("APP_SECRET", "change_this_to_a_long_random_secret")
 JWT_ALG = "HS256"
-DB_PATH = os.environ.get("APP_DB", "minifitna.db")
+# Default lives next to this file so the DB is the same whatever the working directory
+DB_PATH = os.environ.get("APP_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "minifitna.db"))
 OTP_TTL_SECONDS = int(os.environ.get("OTP_TTL_SECONDS", "600"))  # 10 minutes
-logging.debug(f"Config loaded: DB_PATH={DB_PATH}, JWT_ALG={JWT_ALG}, SECRET_KEY_set={bool(SECRET_KEY)}")
+JWT_CACHE_MAX = int(os.environ.get("JWT_CACHE_MAX", "10000"))
+BULK_MAX_ITEMS = int(os.environ.get("BULK_MAX_ITEMS", "1000"))
+LOGIN_MAX_FAILURES = int(os.environ.get("LOGIN_MAX_FAILURES", "5"))
+LOGIN_MAX_FAILURES_PER_IP = int(os.environ.get("LOGIN_MAX_FAILURES_PER_IP", "20"))
+LOGIN_FAILURE_WINDOW_SECONDS = int(os.environ.get("LOGIN_FAILURE_WINDOW_SECONDS", "60"))
+LOGIN_FAILURE_CLIENTS_MAX = int(os.environ.get("LOGIN_FAILURE_CLIENTS_MAX", "10000"))
+_JWT = jwt.PyJWT(options={"require": ["exp"], "verify_signature": True})
+_JWT_ALGS = [JWT_ALG]
+log.debug("Config loaded: DB_PATH=%s, JWT_ALG=%s, SECRET_KEY_set=%s", DB_PATH, JWT_ALG, bool(SECRET_KEY))
 
 # ==== App ====
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1, x_prefix=1)  # type: ignore
-logging.debug("Flask app created, ProxyFix applied")
+log.debug("Flask app created, ProxyFix applied")
 
-# ==== Heartbeat thread ====
+def _json_dumps(obj) -> bytes:
+    # Sorted keys, like flask.jsonify, so output doesn't depend on the encoder
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            # e.g. integers beyond 64 bits, which the stdlib encoder handles
+            pass
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True).encode("utf-8")
+
+def ojsonify(obj, status: int = 200):
+    # Drop-in for flask.jsonify that encodes with orjson when it's installed
+    return app.response_class(_json_dumps(obj), status=status, mimetype="application/json")
+
+def ojsonify_cacheable(obj):
+    # ETag of the body so polling clients get 304s. no-cache makes the client
+    # revalidate every time, so a fresh write is never hidden behind a cached
+    # copy; Vary: Authorization keeps one account's copy from serving another.
+    # The payload is still built on every request: a 304 saves only the body.
+    body = _json_dumps(obj)
+    etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+    # If-None-Match uses weak comparison (RFC 9110 13.1.2), so W/"..." matches too
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = app.response_class(body, status=200, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.vary.add("Authorization")
+    return resp
+
+# ==== Verified JWT cache ====
+# raw token -> (exp, payload). Only successfully decoded tokens are stored,
+# so bad tokens always go through full verification.
+_JWT_CACHE: dict = {}
+_JWT_CACHE_LOCK = threading.Lock()
+_JWT_CACHE_SWEEP_INTERVAL_SECONDS = 60
+_jwt_cache_last_sweep = 0.0
+
+def _jwt_cache_get(token: str):
+    entry = _JWT_CACHE.get(token)
+    if entry is None:
+        return None
+    if entry[0] <= time.time():
+        with _JWT_CACHE_LOCK:
+            _JWT_CACHE.pop(token, None)
+        return None
+    return entry[1]
+
+def _jwt_cache_put(token: str, payload: dict):
+    if "exp" not in payload:
+        return
+    with _JWT_CACHE_LOCK:
+        # A full cache of live tokens would otherwise rescan on every miss
+        if len(_JWT_CACHE) >= JWT_CACHE_MAX and time.time() - _jwt_cache_last_sweep >= _JWT_CACHE_SWEEP_INTERVAL_SECONDS:
+            _jwt_cache_sweep_locked()
+        while len(_JWT_CACHE) >= JWT_CACHE_MAX:
+            # dicts keep insertion order: evict the oldest entry
+            _JWT_CACHE.pop(next(iter(_JWT_CACHE)))
+        _JWT_CACHE[token] = (float(payload["exp"]), payload)
+
+def _jwt_cache_sweep_locked():
+    global _jwt_cache_last_sweep
+    now = _jwt_cache_last_sweep = time.time()
+    expired = [t for t, (exp, _) in _JWT_CACHE.items() if exp <= now]
+    for t in expired:
+        del _JWT_CACHE[t]
+    return len(expired)
+
+def _jwt_cache_sweep():
+    with _JWT_CACHE_LOCK:
+        return _jwt_cache_sweep_locked()
+
+# ==== Heartbeat thread (opt-in) ====
 def _heartbeat():
-    n = 0
     while True:
-        n += 1
-        logging.debug(f"HEARTBEAT #{n} worker alive at {datetime.utcnow().isoformat()}Z")
-        time.sleep(10)
-
-threading.Thread(target=_heartbeat, daemon=True).start()
+        _jwt_cache_sweep()
+        log.info("heartbeat")
+        time.sleep(60)
+
+# Started lazily from the first request each process serves, so a preloading
+# gunicorn master never runs one and every server (forking or not) gets
+# exactly one per serving process.
+_HEARTBEAT_ENABLED = os.environ.get("APP_HEARTBEAT") == "1"
+_heartbeat_pid = None
+_heartbeat_lock = threading.Lock()
+
+def start_heartbeat():
+    global _heartbeat_pid
+    pid = os.getpid()
+    if not _HEARTBEAT_ENABLED or _heartbeat_pid == pid:
+        return
+    with _heartbeat_lock:
+        if _heartbeat_pid == pid:
+            return
+        _heartbeat_pid = pid
+        threading.Thread(target=_heartbeat, daemon=True).start()
 
 # ==== DB Helpers ====
+# One long-lived connection per worker thread; WAL lets readers and the
+# writer proceed concurrently and keeps the page cache warm across requests.
+_db_local = threading.local()
+
+def _connect_db() -> sqlite3.Connection:
+    log.debug("Opening new SQLite connection for thread %s", threading.get_ident())
+    db = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+    db.row_factory = sqlite3.Row
+    db.executescript(
+        """
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -64000;
+        PRAGMA mmap_size = 268435456;
+        PRAGMA foreign_keys = ON;
+        """
+    )
+    return db
+
 def get_db():
     if "db" not in g:
-        logging.debug("Opening new SQLite connection")
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
-    else:
-        logging.debug("Reusing existing SQLite connection from g")
+        db = getattr(_db_local, "db", None)
+        if db is None:
+            db = _db_local.db = _connect_db()
+        g.db = db
     return g.db
 
 @app.teardown_appcontext
 def close_db(exception):
+    # The connection stays open for the next request on this thread; just make
+    # sure a handler that bailed out mid-write doesn't leave a transaction open.
     db = g.pop("db", None)
-    if db is not None:
-        logging.debug("Closing SQLite connection")
-        db.close()
+    if db is not None and db.in_transaction:
+        log.debug("Rolling back uncommitted SQLite transaction")
+        db.rollback()
     if exception:
-        logging.debug(f"Teardown exception: {exception}")
+        log.debug("Teardown exception: %s", exception)
 
 def init_db():
-    logging.debug("Running init_db() to ensure schema")
+    log.debug("Running init_db() to ensure schema")
     db = get_db()
     db.executescript(
         """
@@ -71,6 +204,7 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
             password_hash TEXT NOT NULL,
+            salt TEXT,
             created_at TEXT NOT NULL DEFAULT (datetime('now')),
             target_weight REAL DEFAULT 80.0,
             daily_run_km REAL DEFAULT 10.0,
@@ -111,96 +245,167 @@ def init_db():
         );
 
         CREATE INDEX IF NOT EXISTS idx_reset_otps_user_id ON reset_otps(user_id);
+
+        -- Covering indexes for the per-user, day-ordered list/summary queries
+        CREATE INDEX IF NOT EXISTS idx_weights_user_day ON weights(user_id, day DESC, weight_kg, created_at);
+        CREATE INDEX IF NOT EXISTS idx_runs_user_day ON runs(user_id, day DESC, distance_km, duration_min, created_at);
         """
     )
+    # Older databases predate the per-user salt column
+    cols = {r["name"] for r in db.execute("PRAGMA table_info(users)").fetchall()}
+    if "salt" not in cols:
+        log.debug("init_db(): adding users.salt column")
+        db.execute("ALTER TABLE users ADD COLUMN salt TEXT")
     db.commit()
-    logging.debug("init_db() completed")
+    log.debug("init_db() completed")
+
+def close_thread_db():
+    db = getattr(_db_local, "db", None)
+    if db is not None:
+        _db_local.db = None
+        db.close()
 
 with app.app_context():
     init_db()
+# Don't carry an open SQLite handle into forked gunicorn workers (preload_app)
+close_thread_db()
 
 # ==== Request logging & CORS ====
+# Response-independent CORS headers, built once
+_CORS_STATIC_HEADERS = (
+    ("Access-Control-Allow-Methods", "GET,POST,PUT,DELETE,OPTIONS,PATCH"),
+    ("Access-Control-Expose-Headers", "Content-Type,Authorization"),
+)
+_CORS_PREFLIGHT_HEADERS = _CORS_STATIC_HEADERS + (("Access-Control-Max-Age", "86400"),)
+
 @app.before_request
 def _log_and_cors_preflight():
-    logging.debug(
-        f"Incoming request: {request.method} {request.path} "
-        f"args={dict(request.args)} "
-        f"json={(request.get_json(silent=True) if request.is_json else None)} "
-        f"headers={{'Authorization': 'present' if request.headers.get('Authorization') else 'absent', "
-        f"'Content-Type': request.headers.get('Content-Type'), "
-        f"'Origin': request.headers.get('Origin')}}"
-    )
+    start_heartbeat()
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(
+            "Incoming request: %s %s args=%s json=%s headers={'Authorization': %r, 'Content-Type': %r, 'Origin': %r}",
+            request.method,
+            request.path,
+            dict(request.args),
+            request.get_json(silent=True) if request.is_json else None,
+            "present" if request.headers.get("Authorization") else "absent",
+            request.headers.get("Content-Type"),
+            request.headers.get("Origin"),
+        )
     # Let Flask also handle OPTIONS in case Nginx forwards it.
     if request.method == "OPTIONS":
-        logging.debug("Handling CORS preflight (OPTIONS) in Flask")
+        log.debug("Handling CORS preflight (OPTIONS) in Flask")
         resp = make_response("", 204)
-        origin = request.headers.get("Origin") or "*"
-        req_headers = request.headers.get("Access-Control-Request-Headers")
-        resp.headers["Access-Control-Allow-Origin"] = origin
-        resp.headers["Access-Control-Allow-Methods"] = "GET,POST,PUT,DELETE,OPTIONS,PATCH"
-        resp.headers["Access-Control-Allow-Headers"] = req_headers or "Authorization,Content-Type,Accept"
-        resp.headers["Access-Control-Max-Age"] = "86400"
-        resp.headers["Vary"] = "Origin"
+        headers = request.headers
+        resp.headers["Access-Control-Allow-Origin"] = headers.get("Origin") or "*"
+        resp.headers["Access-Control-Allow-Headers"] = headers.get("Access-Control-Request-Headers") or "Authorization,Content-Type,Accept"
+        resp.headers.extend(_CORS_PREFLIGHT_HEADERS)
+        resp.vary.add("Origin")
         return resp
 
 @app.after_request
 def _log_and_cors_response(resp):
     try:
-        if request.path.startswith("/api"):
-            # Single source of truth for CORS headers (do NOT duplicate in Nginx)
-            origin = request.headers.get("Origin") or "*"
-            req_headers = request.headers.get("Access-Control-Request-Headers")
-            resp.headers["Access-Control-Allow-Origin"] = origin
-            resp.headers["Access-Control-Allow-Methods"] = "GET,POST,PUT,DELETE,OPTIONS,PATCH"
-            resp.headers["Access-Control-Allow-Headers"] = req_headers or "Authorization,Content-Type,Accept"
-            resp.headers["Access-Control-Expose-Headers"] = "Content-Type,Authorization"
-            resp.headers["Vary"] = "Origin"
-        body_preview = resp.get_data(as_text=True)
-        if len(body_preview) > 400:
-            body_preview = body_preview[:400] + "...(truncated)"
-        logging.debug(f"Outgoing response: status={resp.status_code} path={request.path} body={body_preview}")
+        # Single source of truth for CORS headers (do NOT duplicate in Nginx).
+        # Preflights already carry the full set from _log_and_cors_preflight.
+        if request.method != "OPTIONS" and request.path.startswith("/api"):
+            headers = request.headers
+            resp.headers["Access-Control-Allow-Origin"] = headers.get("Origin") or "*"
+            resp.headers["Access-Control-Allow-Headers"] = headers.get("Access-Control-Request-Headers") or "Authorization,Content-Type,Accept"
+            resp.headers.extend(_CORS_STATIC_HEADERS)
+            # Merged into any existing Vary (e.g. Authorization) rather than appended
+            resp.vary.add("Origin")
+        # get_data() copies the whole body, so only preview it when DEBUG is on
+        if log.isEnabledFor(logging.DEBUG) and not resp.direct_passthrough:
+            body_preview = resp.get_data(as_text=True)
+            if len(body_preview) > 400:
+                body_preview = body_preview[:400] + "...(truncated)"
+            log.debug("Outgoing response: status=%s path=%s body=%s", resp.status_code, request.path, body_preview)
     except Exception as e:
-        logging.debug(f"Error logging/adding CORS to response: {e}")
+        log.debug("Error logging/adding CORS to response: %s", e)
     return resp
 
 # ==== Root / Health / Ping / Debug ====
 @app.route("/", methods=["GET"])
 def root():
-    logging.debug("Root / called")
-    return jsonify({"service": "minifitna", "status": "ok", "endpoints": ["/health", "/api/*"]}), 200
+    log.debug("Root / called")
+    return ojsonify({"service": "minifitna", "status": "ok", "endpoints": ["/health", "/api/*"]}, 200)
 
 @app.route("/health", methods=["GET"])
 def health():
-    logging.debug("Health check called")
+    log.debug("Health check called")
     try:
         db = get_db()
         db.execute("SELECT 1")
-        return jsonify({"status": "ok"}), 200
+        return ojsonify({"status": "ok"}, 200)
     except Exception as e:
-        logging.debug(f"Health check error: {e}")
-        return jsonify({"status": "error", "detail": str(e)}), 500
+        log.debug("Health check error: %s", e)
+        return ojsonify({"status": "error", "detail": str(e)}, 500)
 
 @app.route("/api/ping", methods=["GET"])
 def ping():
-    logging.debug("Ping called")
-    return jsonify({"pong": True, "utc": datetime.utcnow().isoformat() + "Z"}), 200
+    log.debug("Ping called")
+    return ojsonify({"pong": True, "utc": datetime.utcnow().isoformat() + "Z"}, 200)
 
 @app.route("/api/debug/echo", methods=["POST"])
 def debug_echo():
     payload = request.get_json(silent=True)
-    logging.debug(f"/api/debug/echo payload={payload}")
-    return jsonify({"ok": True, "you_sent": payload}), 200
+    log.debug("/api/debug/echo payload=%s", payload)
+    return ojsonify({"ok": True, "you_sent": payload}, 200)
 
 # ==== Security helpers ====
-def _hash_password(password: str) -> str:
-    logging.debug("Hashing password with PBKDF2_HMAC (salt static in demo)")
-    salt = b"static_salt_change_me"
-    dk = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 200_000)
+# Accounts created before per-user salts were introduced hash with this one.
+_LEGACY_SALT = b"static_salt_change_me"
+
+def _new_salt() -> str:
+    return os.urandom(16).hex()
+
+def _hash_password(password: str, salt: Optional[str]) -> str:
+    # salt is hex, None means legacy static salt
+    log.debug("Hashing password with PBKDF2_HMAC (per_user_salt=%s)", salt is not None)
+    salt_bytes = bytes.fromhex(salt) if salt else _LEGACY_SALT
+    dk = _pbkdf2_hmac("sha256", password.encode("utf-8"), salt_bytes, 200_000)
     return dk.hex()
 
-def _verify_password(password: str, password_hash: str) -> bool:
-    logging.debug("Verifying password via compare_digest")
-    return hmac.compare_digest(_hash_password(password), password_hash)
+def _verify_password(password: str, password_hash: str, salt: Optional[str]) -> bool:
+    log.debug("Verifying password via compare_digest")
+    return hmac.compare_digest(_hash_password(password, salt), password_hash)
+
+# Failed-login sliding windows -> deque of timestamps, checked before any
+# PBKDF2 work is done. Two keys per attempt:
+#   ("ip", addr)            never cleared; caps guessing across accounts
+#   ("user", addr, name)    cleared on that user's successful login, so a
+#                           user's own typos don't lock them out afterwards
+# The table is per process: with N gunicorn workers the effective limits
+# are N times the configured ones.
+_LOGIN_FAILURES: dict = {}
+_LOGIN_FAILURES_LOCK = threading.Lock()
+
+def _login_failures_recent(key: tuple) -> int:
+    cutoff = time.time() - LOGIN_FAILURE_WINDOW_SECONDS
+    with _LOGIN_FAILURES_LOCK:
+        q = _LOGIN_FAILURES.get(key)
+        if q is None:
+            return 0
+        while q and q[0] <= cutoff:
+            q.popleft()
+        if not q:
+            del _LOGIN_FAILURES[key]
+            return 0
+        return len(q)
+
+def _login_failure_record(key: tuple):
+    with _LOGIN_FAILURES_LOCK:
+        q = _LOGIN_FAILURES.get(key)
+        if q is None:
+            if len(_LOGIN_FAILURES) >= LOGIN_FAILURE_CLIENTS_MAX:
+                _LOGIN_FAILURES.pop(next(iter(_LOGIN_FAILURES)))
+            q = _LOGIN_FAILURES[key] = deque(maxlen=max(LOGIN_MAX_FAILURES, LOGIN_MAX_FAILURES_PER_IP))
+        q.append(time.time())
+
+def _login_failures_clear(key: tuple):
+    with _LOGIN_FAILURES_LOCK:
+        _LOGIN_FAILURES.pop(key, None)
 
 def _normalize_username(u: str) -> str:
     return (u or "").strip().lower()
@@ -210,102 +415,214 @@ def _otp_hash(code: str) -> str:
     return hmac.new(SECRET_KEY.encode("utf-8"), code.encode("utf-8"), hashlib.sha256).hexdigest()
 
 def create_token(user_id: int, username: str) -> str:
-    logging.debug(f"Creating JWT for user_id={user_id}, username={username}")
+    log.debug("Creating JWT for user_id=%s, username=%s", user_id, username)
     payload = {
-        "sub": user_id,
+        "sub": str(user_id),  # RFC 7519: sub is a string; PyJWT 2.10+ enforces it
         "username": username,
         "iat": int(time.time()),
         "exp": int(time.time()) + 60 * 60 * 24 * 14,
     }
     token = jwt.encode(payload, SECRET_KEY, algorithm=JWT_ALG)
-    logging.debug("JWT created")
+    log.debug("JWT created")
     return token
 
 def auth_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
         auth = request.headers.get("Authorization", "")
-        if not auth.startswith("Bearer "):
-            logging.debug("auth_required: missing or malformed Authorization header")
-            return jsonify({"error": "missing_token"}), 401
-        token = auth.split(" ", 1)[1]
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[JWT_ALG])
-            logging.debug(f"auth_required: token valid for user_id={payload.get('sub')}, username={payload.get('username')}")
-        except jwt.PyJWTError as e:
-            logging.debug(f"auth_required: invalid token error={e}")
-            return jsonify({"error": "invalid_token"}), 401
+        if len(auth) < 8 or auth[:7] != "Bearer ":
+            log.debug("auth_required: missing or malformed Authorization header")
+            return ojsonify({"error": "missing_token"}, 401)
+        token = auth[7:]
+        payload = _jwt_cache_get(token)
+        if payload is None:
+            try:
+                payload = _JWT.decode(token, SECRET_KEY, algorithms=_JWT_ALGS)
+                log.debug("auth_required: token valid for user_id=%s, username=%s", payload.get('sub'), payload.get('username'))
+            except jwt.PyJWTError as e:
+                log.debug("auth_required: invalid token error=%s", e)
+                return ojsonify({"error": "invalid_token"}, 401)
+            _jwt_cache_put(token, payload)
         g.user_id = int(payload["sub"])
         g.username = payload["username"]
         return fn(*args, **kwargs)
     return wrapper
 
+# ==== SQL ====
+# Fixed statement text per variant so sqlite3's statement cache can reuse the
+# prepared statements instead of re-parsing freshly concatenated SQL.
+def _list_sql_variants(table: str, cols: str) -> dict:
+    base = f"SELECT {cols} FROM {table} WHERE user_id=?"
+    return {
+        (False, False): base + " ORDER BY day DESC",
+        (True, False): base + " AND day >= ? ORDER BY day DESC",
+        (False, True): base + " AND day <= ? ORDER BY day DESC",
+        (True, True): base + " AND day >= ? AND day <= ? ORDER BY day DESC",
+    }
+
+_WEIGHTS_LIST_SQL = _list_sql_variants("weights", "id, user_id, day, weight_kg, created_at")
+_RUNS_LIST_SQL = _list_sql_variants("runs", "id, user_id, day, distance_km, duration_min, created_at")
+
+_WEIGHTS_UPSERT_SQL = (
+    "INSERT INTO weights (user_id, day, weight_kg) VALUES (?, ?, ?) "
+    "ON CONFLICT(user_id, day) DO UPDATE SET weight_kg=excluded.weight_kg"
+)
+_RUNS_UPSERT_SQL = (
+    "INSERT INTO runs (user_id, day, distance_km, duration_min) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(user_id, day) DO UPDATE SET distance_km=excluded.distance_km, duration_min=excluded.duration_min"
+)
+
+# Walking back from today, row n of a contiguous streak is exactly n days
+# old; gap - rn only grows once the streak breaks, so one COUNT suffices.
+_STREAK_SQL = {
+    table: (
+        "SELECT COUNT(*) AS n FROM ("
+        "  SELECT julianday(?) - julianday(day) AS gap,"
+        "         ROW_NUMBER() OVER (ORDER BY day DESC) - 1 AS rn"
+        f"  FROM {table} WHERE user_id=? AND day <= ?"
+        ") WHERE gap = rn"
+    )
+    for table in ("weights", "runs")
+}
+
+# Prefs, latest weight, delta and 7-day distance in a single round trip
+_SUMMARY_SQL = (
+    "SELECT u.daily_run_km, w.weight_kg AS latest_weight, w.day AS latest_weight_day, "
+    "w.weight_kg - u.target_weight AS delta_to_target, "
+    "COALESCE((SELECT SUM(distance_km) FROM runs WHERE user_id=u.id AND day >= ?), 0.0) AS run_7d_km "
+    "FROM users u LEFT JOIN ("
+    "  SELECT user_id, weight_kg, day FROM weights WHERE user_id=? ORDER BY day DESC LIMIT 1"
+    ") w ON w.user_id = u.id "
+    "WHERE u.id=?"
+)
+
 # ==== Utilities ====
 def today_str() -> str:
     s = date.today().isoformat()
-    logging.debug(f"today_str() -> {s}")
+    log.debug("today_str() -> %s", s)
     return s
 
-def row_to_dict(row: sqlite3.Row) -> dict:
-    d = {k: row[k] for k in row.keys()}
-    logging.debug(f"row_to_dict -> {d}")
-    return d
+def _bulk_row(item, today: str, fields: tuple) -> Optional[tuple]:
+    """(user_id, day, *fields) for one bulk item, or None if it's invalid."""
+    if not isinstance(item, dict):
+        return None
+    day = item.get("day") or today
+    if not isinstance(day, str):
+        return None
+    try:
+        # Stored normalised so the streak query's julianday() always parses it
+        day = date.fromisoformat(day).isoformat()
+        values = tuple(float(item[f]) for f in fields)
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not all(math.isfinite(v) for v in values):
+        return None
+    return (g.user_id, day) + values
+
+def _bulk_upsert(path: str, sql: str, fields: tuple):
+    """Shared body of the /bulk endpoints: validate every item, then one executemany."""
+    data = request.get_json(force=True)
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        log.debug("%s POST: missing items", path)
+        return ojsonify({"error": "items_required"}, 400)
+    if len(items) > BULK_MAX_ITEMS:
+        log.debug("%s POST: too many items (%s)", path, len(items))
+        return ojsonify({"error": "too_many_items", "max": BULK_MAX_ITEMS}, 400)
+    if not items:
+        return ojsonify({"status": "ok", "count": 0})
+    today = today_str()
+    rows = []
+    for i, x in enumerate(items):
+        row = _bulk_row(x, today, fields)
+        if row is None:
+            log.debug("%s POST: invalid item index=%s", path, i)
+            return ojsonify({"error": "invalid_item", "index": i}, 400)
+        rows.append(row)
+    db = get_db()
+    db.executemany(sql, rows)
+    db.commit()
+    log.debug("%s POST upserted %s rows for user_id=%s", path, len(rows), g.user_id)
+    return ojsonify({"status": "ok", "count": len(rows)})
 
 def _generate_otp() -> str:
     # 6-digit numeric OTP, zero-padded
     code = f"{secrets.randbelow(1_000_000):06d}"
-    logging.debug(f"_generate_otp() -> {code}")
+    log.debug("_generate_otp() -> %s", code)
     return code
 
 # ==== Auth ====
 @app.route("/api/register", methods=["POST"])
 def register():
-    logging.debug("Register endpoint called")
+    log.debug("Register endpoint called")
     data = request.get_json(force=True)
     username = _normalize_username(data.get("username"))
     password = data.get("password") or ""
-    logging.debug(f"/api/register payload username={username}, password_len={len(password)}")
+    log.debug("/api/register payload username=%s, password_len=%s", username, len(password))
     if not username or not password:
-        logging.debug("Register validation failed: username/password missing")
-        return jsonify({"error": "username_password_required"}), 400
+        log.debug("Register validation failed: username/password missing")
+        return ojsonify({"error": "username_password_required"}, 400)
 
     db = get_db()
+    salt = _new_salt()
     try:
-        db.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, _hash_password(password)))
+        db.execute(
+            "INSERT INTO users (username, password_hash, salt) VALUES (?, ?, ?)",
+            (username, _hash_password(password, salt), salt),
+        )
         db.commit()
-        logging.debug(f"User inserted: {username}")
+        log.debug("User inserted: %s", username)
     except sqlite3.IntegrityError:
-        logging.debug(f"Register conflict: username_taken {username}")
-        return jsonify({"error": "username_taken"}), 409
+        log.debug("Register conflict: username_taken %s", username)
+        return ojsonify({"error": "username_taken"}, 409)
 
     user_id = db.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()["id"]
     token = create_token(user_id, username)
-    logging.debug(f"Register success: user_id={user_id}")
-    return jsonify({"token": token, "username": username})
+    log.debug("Register success: user_id=%s", user_id)
+    return ojsonify({"token": token, "username": username})
 
 @app.route("/api/login", methods=["POST"])
 def login():
-    logging.debug("Login endpoint called")
+    log.debug("Login endpoint called")
     data = request.get_json(force=True)
     username = _normalize_username(data.get("username"))
     password = data.get("password") or ""
-    logging.debug(f"/api/login payload username={username}, password_len={len(password)}")
+    log.debug("/api/login payload username=%s, password_len=%s", username, len(password))
     if not username or not password:
-        logging.debug("Login validation failed: username/password missing")
-        return jsonify({"error": "username_password_required"}), 400
+        log.debug("Login validation failed: username/password missing")
+        return ojsonify({"error": "username_password_required"}, 400)
+
+    client = request.remote_addr or "unknown"
+    ip_key = ("ip", client)
+    user_key = ("user", client, username)
+    if (_login_failures_recent(ip_key) >= LOGIN_MAX_FAILURES_PER_IP
+            or _login_failures_recent(user_key) >= LOGIN_MAX_FAILURES):
+        log.debug("Login refused: too many recent failures from %s", client)
+        return ojsonify({"error": "too_many_attempts"}, 429)
 
     db = get_db()
-    row = db.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+    row = db.execute("SELECT id, password_hash, salt FROM users WHERE username = ?", (username,)).fetchone()
     if not row:
-        logging.debug("Login failed: user not found")
-        return jsonify({"error": "invalid_credentials"}), 401
-    if not _verify_password(password, row["password_hash"]):
-        logging.debug("Login failed: bad password")
-        return jsonify({"error": "invalid_credentials"}), 401
+        _login_failure_record(ip_key)
+        _login_failure_record(user_key)
+        log.debug("Login failed: user not found")
+        return ojsonify({"error": "invalid_credentials"}, 401)
+    if not _verify_password(password, row["password_hash"], row["salt"]):
+        _login_failure_record(ip_key)
+        _login_failure_record(user_key)
+        log.debug("Login failed: bad password")
+        return ojsonify({"error": "invalid_credentials"}, 401)
+    if not row["salt"]:
+        # Upgrade legacy static-salt hash now that we know the plaintext
+        salt = _new_salt()
+        db.execute("UPDATE users SET password_hash=?, salt=? WHERE id=?", (_hash_password(password, salt), salt, row["id"]))
+        db.commit()
+        log.debug("Login: migrated user_id=%s to per-user salt", row['id'])
 
+    _login_failures_clear(user_key)
     token = create_token(row["id"], username)
-    logging.debug(f"Login success: user_id={row['id']}")
-    return jsonify({"token": token, "username": username})
+    log.debug("Login success: user_id=%s", row['id'])
+    return ojsonify({"token": token, "username": username})
 
 # ==== Password reset via OTP ====
 @app.route("/api/password/forgot", methods=["POST"])
@@ -314,19 +631,19 @@ def password_forgot():
     Accepts: { "username": "name" }
     Generates an OTP, stores a hashed copy with expiry, returns {status, otp} (otp included for demo).
     """
-    logging.debug("/api/password/forgot called")
+    log.debug("/api/password/forgot called")
     data = request.get_json(force=True)
     username = _normalize_username(data.get("username"))
     if not username:
-        logging.debug("password_forgot: missing username")
-        return jsonify({"error": "username_required"}), 400
+        log.debug("password_forgot: missing username")
+        return ojsonify({"error": "username_required"}, 400)
 
     db = get_db()
     user = db.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
     if not user:
         # Do not reveal existence; still return OK
-        logging.debug("password_forgot: user not found (returning generic ok)")
-        return jsonify({"status": "ok"}), 200
+        log.debug("password_forgot: user not found (returning generic ok)")
+        return ojsonify({"status": "ok"}, 200)
 
     user_id = int(user["id"])
 
@@ -343,10 +660,10 @@ def password_forgot():
         (user_id, code_hash, expires_at),
     )
     db.commit()
-    logging.debug(f"password_forgot: OTP created for user_id={user_id}, expires_at={expires_at}")
+    log.debug("password_forgot: OTP created for user_id=%s, expires_at=%s", user_id, expires_at)
 
     # In real life you'd send the OTP via email/SMS. For this demo we return it.
-    return jsonify({"status": "ok", "otp": otp, "expires_at": expires_at})
+    return ojsonify({"status": "ok", "otp": otp, "expires_at": expires_at})
 
 @app.route("/api/password/reset", methods=["POST"])
 def password_reset():
@@ -354,30 +671,30 @@ def password_reset():
     Accepts: { "username": "name", "otp": "123456", "new_password": "..." }
     Validates OTP and sets new password. Returns {status, token, username} on success.
     """
-    logging.debug("/api/password/reset called")
+    log.debug("/api/password/reset called")
     data = request.get_json(force=True)
     username = _normalize_username(data.get("username"))
     otp = (data.get("otp") or "").strip()
     new_password = data.get("new_password") or ""
 
     if not username or not otp or not new_password:
-        logging.debug("password_reset: missing field(s)")
-        return jsonify({"error": "username_otp_newpassword_required"}), 400
+        log.debug("password_reset: missing field(s)")
+        return ojsonify({"error": "username_otp_newpassword_required"}, 400)
 
     if not re.fullmatch(r"\d{6}", otp):
-        logging.debug("password_reset: bad otp format")
-        return jsonify({"error": "invalid_otp_format"}), 400
+        log.debug("password_reset: bad otp format")
+        return ojsonify({"error": "invalid_otp_format"}, 400)
 
     if len(new_password) < 6:
-        logging.debug("password_reset: weak password")
-        return jsonify({"error": "password_too_short"}), 400
+        log.debug("password_reset: weak password")
+        return ojsonify({"error": "password_too_short"}, 400)
 
     db = get_db()
     user = db.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
     if not user:
         # Do not reveal existence
-        logging.debug("password_reset: user not found (generic error)")
-        return jsonify({"error": "invalid_otp"}), 400
+        log.debug("password_reset: user not found (generic error)")
+        return ojsonify({"error": "invalid_otp"}, 400)
 
     user_id = int(user["id"])
     row = db.execute(
@@ -387,16 +704,16 @@ def password_reset():
     ).fetchone()
 
     if not row:
-        logging.debug("password_reset: no active OTP")
-        return jsonify({"error": "no_active_otp"}), 400
+        log.debug("password_reset: no active OTP")
+        return ojsonify({"error": "no_active_otp"}, 400)
 
     otp_id = int(row["id"])
     attempts_left = int(row["attempts_left"])
     if attempts_left <= 0:
         db.execute("UPDATE reset_otps SET consumed=1 WHERE id=?", (otp_id,))
         db.commit()
-        logging.debug("password_reset: attempts exhausted")
-        return jsonify({"error": "otp_locked"}), 400
+        log.debug("password_reset: attempts exhausted")
+        return ojsonify({"error": "otp_locked"}, 400)
 
     # Check expiry
     try:
@@ -406,49 +723,54 @@ def password_reset():
     if datetime.utcnow() > exp:
         db.execute("UPDATE reset_otps SET consumed=1 WHERE id=?", (otp_id,))
         db.commit()
-        logging.debug("password_reset: otp expired")
-        return jsonify({"error": "otp_expired"}), 400
+        log.debug("password_reset: otp expired")
+        return ojsonify({"error": "otp_expired"}, 400)
 
     # Check code
     provided_hash = _otp_hash(otp)
     if not hmac.compare_digest(provided_hash, row["code_hash"]):
         db.execute("UPDATE reset_otps SET attempts_left=attempts_left-1 WHERE id=?", (otp_id,))
         db.commit()
-        logging.debug("password_reset: otp mismatch")
-        return jsonify({"error": "invalid_otp", "attempts_left": attempts_left - 1}), 400
+        log.debug("password_reset: otp mismatch")
+        return ojsonify({"error": "invalid_otp", "attempts_left": attempts_left - 1}, 400)
 
     # All good: set new password and consume OTP
-    db.execute("UPDATE users SET password_hash=? WHERE id=?", (_hash_password(new_password), user_id))
+    salt = _new_salt()
+    db.execute(
+        "UPDATE users SET password_hash=?, salt=? WHERE id=?",
+        (_hash_password(new_password, salt), salt, user_id),
+    )
     db.execute("UPDATE reset_otps SET consumed=1 WHERE id=?", (otp_id,))
     db.commit()
-    logging.debug(f"password_reset: password updated for user_id={user_id}")
+    log.debug("password_reset: password updated for user_id=%s", user_id)
 
     token = create_token(user_id, username)
-    return jsonify({"status": "ok", "token": token, "username": username})
+    return ojsonify({"status": "ok", "token": token, "username": username})
 
 # ==== Profile, Weights, Runs, Summary ====
 @app.route("/api/me", methods=["GET"])
 @auth_required
 def me_get():
-    logging.debug(f"/api/me GET for user_id={g.user_id}")
+    log.debug("/api/me GET for user_id=%s", g.user_id)
     db = get_db()
     row = db.execute(
         "SELECT id, username, target_weight, daily_run_km, weigh_time, run_time FROM users WHERE id = ?",
         (g.user_id,),
     ).fetchone()
-    logging.debug(f"/api/me GET row={dict(row) if row else None}")
-    return jsonify(row_to_dict(row))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("/api/me GET row=%s", dict(row) if row else None)
+    return ojsonify_cacheable(dict(row))
 
 @app.route("/api/me", methods=["PUT"])
 @auth_required
 def me_update():
-    logging.debug(f"/api/me PUT for user_id={g.user_id}")
+    log.debug("/api/me PUT for user_id=%s", g.user_id)
     data = request.get_json(force=True)
     target_weight = float(data.get("target_weight", 80.0))
     daily_run_km = float(data.get("daily_run_km", 10.0))
     weigh_time = data.get("weigh_time", "08:00")
     run_time = data.get("run_time", "18:00")
-    logging.debug(f"/api/me PUT payload target_weight={target_weight}, daily_run_km={daily_run_km}, weigh_time={weigh_time}, run_time={run_time}")
+    log.debug("/api/me PUT payload target_weight=%s, daily_run_km=%s, weigh_time=%s, run_time=%s", target_weight, daily_run_km, weigh_time, run_time)
 
     db = get_db()
     db.execute(
@@ -460,28 +782,24 @@ def me_update():
         "SELECT id, username, target_weight, daily_run_km, weigh_time, run_time FROM users WHERE id = ?",
         (g.user_id,),
     ).fetchone()
-    logging.debug("/api/me PUT updated row fetched")
-    return jsonify(row_to_dict(row))
+    log.debug("/api/me PUT updated row fetched")
+    return ojsonify(dict(row))
 
 @app.route("/api/weights", methods=["GET"])
 @auth_required
 def weights_list():
     start = request.args.get("start")
     end = request.args.get("end")
-    logging.debug(f"/api/weights GET user_id={g.user_id} start={start} end={end}")
+    log.debug("/api/weights GET user_id=%s start=%s end=%s", g.user_id, start, end)
     db = get_db()
-    sql = "SELECT * FROM weights WHERE user_id=?"
     params = [g.user_id]
     if start:
-        sql += " AND day >= ?"
         params.append(start)
     if end:
-        sql += " AND day <= ?"
         params.append(end)
-    sql += " ORDER BY day DESC"
-    rows = db.execute(sql, params).fetchall()
-    logging.debug(f"/api/weights GET returned {len(rows)} rows")
-    return jsonify([row_to_dict(r) for r in rows])
+    rows = db.execute(_WEIGHTS_LIST_SQL[(bool(start), bool(end))], params).fetchall()
+    log.debug("/api/weights GET returned %s rows", len(rows))
+    return ojsonify([dict(r) for r in rows])
 
 @app.route("/api/weights", methods=["POST"])
 @auth_required
@@ -489,36 +807,37 @@ def weights_add():
     data = request.get_json(force=True)
     day = data.get("day") or today_str()
     weight_kg = float(data.get("weight_kg"))
-    logging.debug(f"/api/weights POST user_id={g.user_id} day={day} weight_kg={weight_kg}")
+    log.debug("/api/weights POST user_id=%s day=%s weight_kg=%s", g.user_id, day, weight_kg)
     db = get_db()
-    db.execute(
-        "INSERT INTO weights (user_id, day, weight_kg) VALUES (?, ?, ?) "
-        "ON CONFLICT(user_id, day) DO UPDATE SET weight_kg=excluded.weight_kg",
-        (g.user_id, day, weight_kg),
-    )
+    db.execute(_WEIGHTS_UPSERT_SQL, (g.user_id, day, weight_kg))
     db.commit()
-    logging.debug("/api/weights POST upserted")
-    return jsonify({"status": "ok", "day": day, "weight_kg": weight_kg})
+    log.debug("/api/weights POST upserted")
+    return ojsonify({"status": "ok", "day": day, "weight_kg": weight_kg})
+
+@app.route("/api/weights/bulk", methods=["POST"])
+@auth_required
+def weights_bulk_add():
+    """
+    Accepts: { "items": [ { "day": "YYYY-MM-DD", "weight_kg": 81.2 }, ... ] }
+    Upserts up to BULK_MAX_ITEMS items in one transaction (offline sync). Returns {status, count}.
+    """
+    return _bulk_upsert("/api/weights/bulk", _WEIGHTS_UPSERT_SQL, ("weight_kg",))
 
 @app.route("/api/runs", methods=["GET"])
 @auth_required
 def runs_list():
     start = request.args.get("start")
     end = request.args.get("end")
-    logging.debug(f"/api/runs GET user_id={g.user_id} start={start} end={end}")
+    log.debug("/api/runs GET user_id=%s start=%s end=%s", g.user_id, start, end)
     db = get_db()
-    sql = "SELECT * FROM runs WHERE user_id=?"
     params = [g.user_id]
     if start:
-        sql += " AND day >= ?"
         params.append(start)
     if end:
-        sql += " AND day <= ?"
         params.append(end)
-    sql += " ORDER BY day DESC"
-    rows = db.execute(sql, params).fetchall()
-    logging.debug(f"/api/runs GET returned {len(rows)} rows")
-    return jsonify([row_to_dict(r) for r in rows])
+    rows = db.execute(_RUNS_LIST_SQL[(bool(start), bool(end))], params).fetchall()
+    log.debug("/api/runs GET returned %s rows", len(rows))
+    return ojsonify([dict(r) for r in rows])
 
 @app.route("/api/runs", methods=["POST"])
 @auth_required
@@ -527,57 +846,50 @@ def runs_add():
     day = data.get("day") or today_str()
     distance_km = float(data.get("distance_km"))
     duration_min = float(data.get("duration_min"))
-    logging.debug(f"/api/runs POST user_id={g.user_id} day={day} distance_km={distance_km} duration_min={duration_min}")
+    log.debug("/api/runs POST user_id=%s day=%s distance_km=%s duration_min=%s", g.user_id, day, distance_km, duration_min)
     db = get_db()
-    db.execute(
-        "INSERT INTO runs (user_id, day, distance_km, duration_min) VALUES (?, ?, ?, ?) "
-        "ON CONFLICT(user_id, day) DO UPDATE SET distance_km=excluded.distance_km, duration_min=excluded.duration_min",
-        (g.user_id, day, distance_km, duration_min),
-    )
+    db.execute(_RUNS_UPSERT_SQL, (g.user_id, day, distance_km, duration_min))
     db.commit()
-    logging.debug("/api/runs POST upserted")
-    return jsonify({"status": "ok", "day": day, "distance_km": distance_km, "duration_min": duration_min})
+    log.debug("/api/runs POST upserted")
+    return ojsonify({"status": "ok", "day": day, "distance_km": distance_km, "duration_min": duration_min})
+
+@app.route("/api/runs/bulk", methods=["POST"])
+@auth_required
+def runs_bulk_add():
+    """
+    Accepts: { "items": [ { "day": "YYYY-MM-DD", "distance_km": 5.0, "duration_min": 28 }, ... ] }
+    Upserts up to BULK_MAX_ITEMS items in one transaction (offline sync). Returns {status, count}.
+    """
+    return _bulk_upsert("/api/runs/bulk", _RUNS_UPSERT_SQL, ("distance_km", "duration_min"))
 
 @app.route("/api/summary", methods=["GET"])
 @auth_required
 def summary():
-    logging.debug(f"/api/summary GET user_id={g.user_id}")
+    log.debug("/api/summary GET user_id=%s", g.user_id)
     db = get_db()
-    w = db.execute("SELECT weight_kg, day FROM weights WHERE user_id=? ORDER BY day DESC LIMIT 1", (g.user_id,)).fetchone()
-    latest_weight = w["weight_kg"] if w else None
-    latest_weight_day = w["day"] if w else None
-    u = db.execute("SELECT target_weight, daily_run_km FROM users WHERE id=?", (g.user_id,)).fetchone()
-    target_weight = u["target_weight"]
-    daily_run_km = u["daily_run_km"]
-    delta_to_target = None if latest_weight is None else (latest_weight - target_weight)
     start7 = (date.today() - timedelta(days=6)).isoformat()
-    r7 = db.execute("SELECT SUM(distance_km) AS km FROM runs WHERE user_id=? AND day >= ?", (g.user_id, start7)).fetchone()
-    run_7d_km = float(r7["km"] or 0.0)
+    u = db.execute(_SUMMARY_SQL, (start7, g.user_id, g.user_id)).fetchone()
 
     def streak(table: str) -> int:
-        d = date.today()
-        s = 0
-        while True:
-            exists = db.execute(f"SELECT 1 FROM {table} WHERE user_id=? AND day=? LIMIT 1", (g.user_id, d.isoformat())).fetchone()
-            if not exists:
-                break
-            s += 1
-            d -= timedelta(days=1)
-        logging.debug(f"/api/summary streak calc table={table} result={s}")
+        today = date.today().isoformat()
+        s = db.execute(_STREAK_SQL[table], (today, g.user_id, today)).fetchone()["n"]
+        log.debug("/api/summary streak calc table=%s result=%s", table, s)
         return s
 
     payload = {
-        "latest_weight": latest_weight,
-        "latest_weight_day": latest_weight_day,
-        "delta_to_target": delta_to_target,
-        "daily_run_goal_km": float(daily_run_km),
-        "run_7d_km": run_7d_km,
+        "latest_weight": u["latest_weight"],
+        "latest_weight_day": u["latest_weight_day"],
+        "delta_to_target": u["delta_to_target"],
+        "daily_run_goal_km": float(u["daily_run_km"]),
+        "run_7d_km": float(u["run_7d_km"]),
         "weigh_streak": streak("weights"),
         "run_streak": streak("runs")
     }
-    logging.debug(f"/api/summary payload={payload}")
-    return jsonify(payload)
+    log.debug("/api/summary payload=%s", payload)
+    return ojsonify_cacheable(payload)
 
 if __name__ == "__main__":
-    logging.debug("Running app via __main__ on port 8743")
+    # Development server only. In production run from the repo root:
+    #   gunicorn -c backend/gunicorn_conf.py backend.app:app
+    log.debug("Running app via __main__ on port 8743")
     app.run(host="0.0.0.0", port=8743, debug=False)
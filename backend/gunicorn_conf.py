@@ -0,0 +1,11 @@
+# Production entrypoint (run from the repo root):
+#   gunicorn -c backend/gunicorn_conf.py backend.app:app
+import os
+
+bind = os.environ.get("APP_BIND", "0.0.0.0:8743")
+workers = int(os.environ.get("APP_WORKERS", str(2 * (os.cpu_count() or 1) + 1)))
+worker_class = "gthread"
+threads = int(os.environ.get("APP_THREADS", "4"))
+# Import app (and run init_db) once in the master; workers share those pages copy-on-write.
+# The opt-in heartbeat starts in each worker on its first request, not in the master.
+preload_app = True